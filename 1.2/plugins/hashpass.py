@@ -4,18 +4,325 @@ hashpass.py: Hashes arbitrary passwords via supported algorithms.
 """
 
 __authors__ = [('Ken Spencer (Iota)', 'iota@electrocode.net')]
-__version__ = '0.0.1'
+__version__ = '0.0.2'
 
-from pylinkirc import utils
+from pylinkirc import utils, conf
 from pylinkirc.log import log
 
-import re
+import os
+import sys
+import ssl
+import json
+import time
+import bisect
+import platform
+import base64
 import hashlib
+import threading
+import collections
+import multiprocessing
+import concurrent.futures
+import concurrent.futures.process
 
+try:
+    import bcrypt
+except ImportError:
+    bcrypt = None
+    log.debug("hashpass: bcrypt is not installed, bcrypt hashing will be unavailable")
+
+# Key derivation functions are slow by design, so they run in a separate pool of processes to
+# avoid blocking PyLink.
+KDF_WORKERS = conf.conf.get('hashpass', {}).get('kdf_workers', 2)
+# How many KDF requests may be waiting at once, per user and overall.
+KDF_MAX_PER_USER = conf.conf.get('hashpass', {}).get('kdf_max_per_user', 2)
+KDF_MAX_QUEUED = conf.conf.get('hashpass', {}).get('kdf_max_queued', 8)
+# Target time for 'hashcalibrate', in milliseconds.
+DEFAULT_CALIBRATION_TARGET = 250
+# Total time 'hashbench' may spend measuring, in seconds, and the input sizes it measures with.
+BENCH_BUDGET = conf.conf.get('hashpass', {}).get('bench_budget', 10)
+BENCH_SIZES = (64, 1024, 65536)
+# Number of results 'hashbench' shows by default.
+BENCH_DEFAULT_COUNT = 10
+BENCH_DB = utils.getDatabaseName('hashbench')
+COSTS_DB = utils.getDatabaseName('hashpass-costs')
+
+# Supported KDFs and their default cost parameters: the iteration count for PBKDF2, and log2 of
+# the work factor for scrypt and bcrypt. Use 'hashcalibrate' to tune these for this host; the
+# calibrated costs are saved per host/Python build (see _bench_key()) and loaded by main().
+kdf_costs = {'pbkdf2-sha256': 200000, 'pbkdf2-sha512': 100000}
+if hasattr(hashlib, 'scrypt'):
+    kdf_costs['scrypt'] = 15
+if bcrypt is not None:
+    kdf_costs['bcrypt'] = 12
+
+# Bounds used by 'hashcalibrate'. The scrypt limit keeps memory use (128 * 8 * 2**cost bytes)
+# at 128 MiB.
+KDF_COST_LIMITS = {'pbkdf2-sha256': (1000, 10000000), 'pbkdf2-sha512': (1000, 10000000),
+                   'scrypt': (10, 17), 'bcrypt': (4, 16)}
+SCRYPT_BLOCKSIZE = 8
+
+# Sorted index of everything 'hash' accepts, used by 'algorithms'.
+ALGORITHMS = sorted(set(hashlib.algorithms_available) | set(kdf_costs), key=str.lower)
+_ALGORITHMS_LOWER = [name.lower() for name in ALGORITHMS]
+
+pool = None
+# Cached 'hashbench' results, by host/Python build (see _bench_key()).
+bench_results = None
+bench_running = False
+# Number of KDF requests in progress per (network, user) pair.
+pending = collections.Counter()
+pending_lock = threading.Lock()
+pool_lock = threading.Lock()
+costs_lock = threading.Lock()
+
+def _new_pool():
+    """
+    Creates the KDF worker pool. Workers are forked, since PyLink loads this plugin from a
+    package path that is only extended at runtime: a freshly spawned interpreter (the default
+    start method on macOS, and on Linux from Python 3.14) couldn't import our worker functions.
+    """
+    try:
+        context = multiprocessing.get_context('fork')
+    except ValueError:  # fork isn't available on this platform
+        context = None
+    if context is None or sys.version_info < (3, 7):
+        # Python < 3.7 doesn't take a context, but always forks where it can.
+        return concurrent.futures.ProcessPoolExecutor(max_workers=KDF_WORKERS)
+    return concurrent.futures.ProcessPoolExecutor(max_workers=KDF_WORKERS, mp_context=context)
+
+def main(irc=None):
+    global pool
+    pool = _new_pool()
+    with costs_lock:
+        costs = _load_costs().get(_bench_key(), {})
+    for kdf, cost in costs.items():
+        if kdf in kdf_costs and isinstance(cost, int):
+            low, high = KDF_COST_LIMITS[kdf]
+            kdf_costs[kdf] = min(max(cost, low), high)
+
+def _restart_pool(broken):
+    """
+    Replaces the worker pool if it is still the given broken one, e.g. after a worker process
+    was killed by the OOM killer.
+    """
+    global pool
+    with pool_lock:
+        if pool is broken:
+            log.warning("hashpass: worker pool is broken, restarting it")
+            broken.shutdown(wait=False)
+            pool = _new_pool()
+
+def die(irc=None):
+    if pool is not None:
+        pool.shutdown(wait=False)
+
+def _b64(data):
+    """Encodes data in unpadded standard base64, as used by the $scrypt$ format."""
+    return base64.b64encode(data).decode('ascii').rstrip('=')
+
+def _ab64(data):
+    """Encodes data in the unpadded "adapted base64" used by passlib's modular crypt formats."""
+    return base64.b64encode(data).decode('ascii').rstrip('=').replace('+', '.')
+
+def _derive(kdf, password, cost):
+    """
+    Hashes password (as bytes) with the given KDF and cost, returning it in modular crypt format.
+    This runs in a worker process.
+    """
+    if kdf.startswith('pbkdf2-'):
+        digest = kdf.split('-', 1)[1]
+        salt = os.urandom(16)
+        key = hashlib.pbkdf2_hmac(digest, password, salt, cost)
+        return '$pbkdf2-%s$%d$%s$%s' % (digest, cost, _ab64(salt), _ab64(key))
+    elif kdf == 'scrypt':
+        salt = os.urandom(16)
+        n = 2 ** cost
+        key = hashlib.scrypt(password, salt=salt, n=n, r=SCRYPT_BLOCKSIZE, p=1, dklen=32,
+                             maxmem=256 * SCRYPT_BLOCKSIZE * n)
+        return '$scrypt$ln=%d,r=%d,p=1$%s$%s' % (cost, SCRYPT_BLOCKSIZE, _b64(salt), _b64(key))
+    elif kdf == 'bcrypt':
+        return bcrypt.hashpw(password, bcrypt.gensalt(rounds=cost)).decode('ascii')
+    raise ValueError("Unknown KDF %r" % kdf)
+
+def _time_kdf(kdf, cost):
+    """Returns how long (in seconds) one hash with the given KDF and cost takes."""
+    start = time.perf_counter()
+    _derive(kdf, b'hashpass calibration', cost)
+    return time.perf_counter() - start
+
+def _calibrate(kdf, target):
+    """
+    Finds the cost for the given KDF that takes closest to target seconds per hash. This runs
+    in a worker process.
+    """
+    low, high = KDF_COST_LIMITS[kdf]
+    if kdf.startswith('pbkdf2-'):
+        # PBKDF2 time is linear in the iteration count, so scale from a sample run.
+        cost = low * 10
+        elapsed = _time_kdf(kdf, cost)
+        cost = int(cost * target / elapsed) // 1000 * 1000
+        cost = min(max(cost, low), high)
+        return (cost, _time_kdf(kdf, cost))
+
+    # scrypt and bcrypt costs are exponents: each step doubles the time taken.
+    cost = low
+    elapsed = _time_kdf(kdf, cost)
+    while cost < high and elapsed * 2 <= target * 1.5:
+        cost += 1
+        elapsed = _time_kdf(kdf, cost)
+    return (cost, elapsed)
+
+def _benchmark(names, sizes, budget):
+    """
+    Measures the throughput (in bytes per second) of each hashlib algorithm given, for each
+    input size, splitting the time budget evenly between them. This runs in a worker process.
+    Returns a dict mapping algorithm names to lists of throughputs, in the order of sizes.
+    """
+    results = {}
+    timeslice = budget / (len(names) * len(sizes))
+    for name in names:
+        try:
+            hashlib.new(name)
+        except ValueError:  # Listed, but disabled in this OpenSSL build
+            continue
+
+        results[name] = []
+        for size in sizes:
+            data = os.urandom(size)
+            rounds = 0
+            start = time.perf_counter()
+            deadline = start + timeslice
+            while True:
+                hashlib.new(name, data)
+                rounds += 1
+                now = time.perf_counter()
+                if now >= deadline:
+                    break
+            results[name].append(rounds * size / (now - start))
+    return results
+
+def _bench_key():
+    """Returns the key benchmark results are cached under: this host, Python and OpenSSL build."""
+    return '%s|%s|%s' % (platform.node(), sys.version.split()[0], ssl.OPENSSL_VERSION)
+
+def _load_bench_results():
+    global bench_results
+    if bench_results is None:
+        try:
+            with open(BENCH_DB) as f:
+                bench_results = json.load(f)
+        except (OSError, ValueError):
+            bench_results = {}
+    return bench_results
+
+def _save_bench_results():
+    try:
+        with open(BENCH_DB, 'w') as f:
+            json.dump(bench_results, f)
+    except OSError:
+        log.warning("hashpass: could not save benchmark results to %s", BENCH_DB, exc_info=True)
+
+def _load_costs():
+    """Returns the saved 'hashcalibrate' costs, by host/Python build."""
+    try:
+        with open(COSTS_DB) as f:
+            costs = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return costs if isinstance(costs, dict) else {}
+
+def _save_cost(kdf, cost):
+    """Saves a calibrated cost for this host/Python build."""
+    with costs_lock:
+        costs = _load_costs()
+        costs.setdefault(_bench_key(), {})[kdf] = cost
+        try:
+            with open(COSTS_DB, 'w') as f:
+                json.dump(costs, f)
+        except OSError:
+            log.warning("hashpass: could not save calibrated costs to %s", COSTS_DB, exc_info=True)
+
+def _format_size(size):
+    if size >= 1024:
+        return '%sKiB' % (size // 1024)
+    return '%sB' % size
+
+def _show_bench(irc, source, results, count):
+    """Sends the fastest count results, ranked by throughput on the largest input size."""
+    ranked = sorted(results.items(), key=lambda item: item[1][-1], reverse=True)
+    for rank, (name, speeds) in enumerate(ranked[:count], 1):
+        speeds = '  '.join('%s: %.0f MB/s' % (_format_size(size), speed / 1e6)
+                           for size, speed in zip(BENCH_SIZES, speeds))
+        irc.msg(source, "%2d. %-12s %s" % (rank, name, speeds), notice=True)
+    irc.msg(source, "Showing %s of %s algorithms (%s)." % (min(count, len(ranked)), len(ranked), _bench_key()),
+            notice=True)
+
+def _submit(irc, source, label, func, *args, callback=None, errback=None, limited=True):
+    """
+    Runs func in the worker pool on behalf of source. Unless limited is False, the per-user and
+    overall limits on hash requests are enforced.
+    callback is called with the result once done, and should reply using irc.msg() since the
+    original command context will be gone by then. errback (if given) is called with no
+    arguments if func fails. Returns True if the job was queued.
+
+    label describes the job (e.g. the KDF name) in logs. The arguments are never logged, since
+    they may include passwords.
+    """
+    key = (irc.name, source)
+    if limited:
+        with pending_lock:
+            if pending[key] >= KDF_MAX_PER_USER:
+                irc.error("you already have %s hash requests in progress, please wait for them to finish" % pending[key],
+                          private=True)
+                return False
+            elif sum(pending.values()) >= KDF_MAX_QUEUED:
+                irc.error("too many hash requests are in progress, please try again later", private=True)
+                return False
+            pending[key] += 1
+
+    def _release():
+        if not limited:
+            return
+        with pending_lock:
+            pending[key] -= 1
+            if pending[key] <= 0:
+                del pending[key]
+
+    current_pool = pool
+    def _done(future):
+        _release()
+        try:
+            result = future.result()
+        except Exception as e:
+            if isinstance(e, concurrent.futures.process.BrokenProcessPool):
+                _restart_pool(current_pool)
+            log.exception("hashpass: error running %s (%s)", func.__name__, label)
+            irc.msg(source, "Error: %s: %s" % (type(e).__name__, e), notice=True)
+            if errback is not None:
+                errback()
+        else:
+            callback(result)
+
+    try:
+        try:
+            future = current_pool.submit(func, *args)
+        except concurrent.futures.process.BrokenProcessPool:
+            _restart_pool(current_pool)
+            current_pool = pool
+            future = current_pool.submit(func, *args)
+    except Exception as e:
+        _release()
+        log.exception("hashpass: could not queue %s (%s)", func.__name__, label)
+        irc.error("could not start the request: %s: %s" % (type(e).__name__, e), private=True)
+        return False
+
+    future.add_done_callback(_done)
+    return True
 
 def _hash(irc, source, args):
     """<password> [digest]
-    Hashes a given password with the given digest, when 'digest' isn't given, defaults to sha256"""
+    Hashes a given password with the given digest, when 'digest' isn't given, defaults to sha256.
+    The key derivation functions pbkdf2-sha256, pbkdf2-sha512, scrypt and bcrypt (where available) are also supported, for IRCd oper and link passwords. These take a moment, and the result is sent when ready."""
     digest = ""
     try:
         password = args[0]
@@ -27,7 +334,12 @@ def _hash(irc, source, args):
         # DRY'ing
         digests = hashlib.algorithms_available
         if digest:
-            if digest in digests:
+            if digest.lower() in kdf_costs:
+                digest = digest.lower()
+                cost = kdf_costs[digest]
+                _submit(irc, source, digest, _derive, digest, password, cost,
+                        callback=lambda result: irc.msg(source, result, notice=True))
+            elif digest in digests:
                 d = hashlib.new("%s" % digest)
                 d.update(password)
                 irc.reply(d.hexdigest(), private=True)
@@ -46,13 +358,107 @@ def algorithms(irc, source, args):
     When given '.' gives all available algorithms, or will filter the available when given a starting few characters."""
     try:
         digest = args[0]
-        pattern = re.compile(r"%s.*" % digest, re.I)
-        avail_digests = filter(pattern.search, list(hashlib.algorithms_available))
+        if digest == '.':
+            avail_digests = ALGORITHMS
+        else:
+            digest = digest.lower()
+            start = bisect.bisect_left(_ALGORITHMS_LOWER, digest)
+            # Everything starting with the query sorts before the query followed by the
+            # highest character.
+            end = bisect.bisect_left(_ALGORITHMS_LOWER, digest + '\U0010ffff', start)
+            avail_digests = ALGORITHMS[start:end]
         avail_digests = " \xB7 ".join(avail_digests)
         irc.reply(avail_digests, private=True)
     except IndexError:
         irc.error("Not enough arguments. Needs 1: query.", private=True)
 
 
+def hashbench(irc, source, args):
+    """[count] [refresh]
+    Shows the throughput of the fastest 'count' (default 10) hashlib algorithms on this host, for several input sizes. Results are measured once per host and Python build and then cached; give 'refresh' to measure again.
+    Only one benchmark runs at a time. It doesn't count towards the hash request limits, but it occupies one of the KDF worker processes while it runs."""
+    irc.checkAuthenticated(source, allowOper=False)
+    global bench_running
+    count = BENCH_DEFAULT_COUNT
+    refresh = False
+    for arg in args:
+        if arg.lower() == 'refresh':
+            refresh = True
+            continue
+        try:
+            count = int(arg)
+        except ValueError:
+            irc.error("invalid argument '%s', expected a count or 'refresh'" % arg, private=True)
+            return
+        if count <= 0:
+            irc.error("count must be positive", private=True)
+            return
+
+    key = _bench_key()
+    results = _load_bench_results().get(key)
+    if results and not refresh:
+        _show_bench(irc, source, results, count)
+        return
+    elif bench_running:
+        irc.error("a benchmark is already running, please wait for it to finish", private=True)
+        return
+
+    def _finished():
+        global bench_running
+        bench_running = False
+
+    def _benchmarked(results):
+        _finished()
+        bench_results[key] = results
+        _save_bench_results()
+        _show_bench(irc, source, results, count)
+
+    names = sorted(hashlib.algorithms_available)
+    if _submit(irc, source, 'benchmark', _benchmark, names, BENCH_SIZES, BENCH_BUDGET, callback=_benchmarked,
+               errback=_finished, limited=False):
+        bench_running = True
+        irc.reply("Benchmarking %s algorithms, this will take about %s seconds..." % (len(names), BENCH_BUDGET),
+                  private=True)
+
+
+def calibrate(irc, source, args):
+    """<kdf> [target milliseconds]
+    Finds the cost parameter for the given key derivation function that takes about the target time (default 250ms) per hash on this host, and uses it for 'hash' from now on. The cost is saved, and kept across restarts on the same host and Python build."""
+    irc.checkAuthenticated(source, allowOper=False)
+    try:
+        kdf = args[0].lower()
+    except IndexError:
+        irc.error("Not enough arguments. Needs 1-2: kdf, target milliseconds (optional).", private=True)
+        return
+    if kdf not in kdf_costs:
+        irc.error("'%s' is not a supported key derivation function (choose from: %s)" %
+                  (kdf, ', '.join(sorted(kdf_costs))), private=True)
+        return
+
+    try:
+        target = int(args[1])
+    except IndexError:
+        target = DEFAULT_CALIBRATION_TARGET
+    except ValueError:
+        irc.error("target time must be a number of milliseconds", private=True)
+        return
+    if target <= 0:
+        irc.error("target time must be positive", private=True)
+        return
+
+    def _calibrated(result):
+        cost, elapsed = result
+        kdf_costs[kdf] = cost
+        _save_cost(kdf, cost)
+        log.info("hashpass: calibrated %s to cost %s (%.0fms per hash)", kdf, cost, elapsed * 1000)
+        irc.msg(source, "%s cost set to %s (%.0fms per hash on this host)" % (kdf, cost, elapsed * 1000),
+                notice=True)
+
+    if _submit(irc, source, kdf, _calibrate, kdf, target / 1000, callback=_calibrated):
+        irc.reply("Calibrating %s for %sms per hash, this may take a few seconds..." % (kdf, target), private=True)
+
+
 utils.add_cmd(algorithms, "algorithms", featured=True)
 utils.add_cmd(_hash, "hash", featured=True)
+utils.add_cmd(calibrate, "hashcalibrate")
+utils.add_cmd(hashbench, "hashbench")
@@ -4,110 +4,708 @@ as them. Useful for training AI bots and the like.
 """
 
 __authors__ = [('James Lu', 'james@overdrivenetworks.com')]
-__version__ = '0.1'
+__version__ = '0.2'
 
 import re
 import glob
 import time
 import threading
+import heapq
+import itertools
+import bisect
+import json
+import os
 import os.path
 import string
+import tempfile
 
 from pylinkirc import utils, conf
 from pylinkirc.log import log
 
-CHAT_REGEX = re.compile(r"^\[(?:[0-9]{2}\:){2}[0-9]{2}\] <(.+?)> (.*)$")
-ACTION_REGEX = re.compile(r"^\[(?:[0-9]{2}\:){2}[0-9]{2}\] \* (\S+?) (.*)$")
-# Hostname and server name used by clients.
+CHAT_REGEX = re.compile(r"^\[((?:[0-9]{2}\:){2}[0-9]{2})\] <(.+?)> (.*)$")
+ACTION_REGEX = re.compile(r"^\[((?:[0-9]{2}\:){2}[0-9]{2})\] \* (\S+?) (.*)$")
+# Hostname used by clients.
 HOSTNAME = 'mimic.int'
+# Server name used by each replay's clients, formatted with the replay ID. Server names must be
+# unique, so that replays can run at the same time.
+SERVERNAME = 'mimic%s.int'
 # Sets the delay between speaking lines, in order to prevent excess flood.
 LINEDELAY = 0.15
 # Suffix appended to nicks if a nick in the chatlogs is taken.
 MIMICSUFFIX = '|mimic'
+# How many clients to join in each SJOIN when bursting a replay's clients.
+SJOIN_CHUNK = 12
+# In timed replays, idle gaps between lines longer than this (in log seconds, before applying the
+# speed factor) are compressed down to it.
+MAXGAP = 30
+# Global send budget shared by all running replays: the sustained rate in lines per second, and
+# how many lines may be sent in a burst.
+DEFAULT_MAXRATE = 10
+DEFAULT_BURST = 5
+MAXRATE = conf.conf.get('mimic', {}).get('max_rate', DEFAULT_MAXRATE)
+BURST = conf.conf.get('mimic', {}).get('burst', DEFAULT_BURST)
+if isinstance(MAXRATE, bool) or not isinstance(MAXRATE, (int, float)) or MAXRATE <= 0:
+    log.warning('mimic: max_rate must be a positive number, not %r; using %s instead', MAXRATE, DEFAULT_MAXRATE)
+    MAXRATE = DEFAULT_MAXRATE
+if isinstance(BURST, bool) or not isinstance(BURST, (int, float)) or BURST < 1:
+    log.warning('mimic: burst must be a number of at least 1, not %r; using %s instead', BURST, DEFAULT_BURST)
+    BURST = DEFAULT_BURST
+# Suffix of the index files written next to each log file.
+INDEX_SUFFIX = '.mimicidx'
+INDEX_VERSION = 1
+INDEX_KEYS = ('version', 'mtime', 'size', 'offsets', 'lines', 'timestamps', 'speakers')
+# File storing where cancelled replays left off, so that they can be resumed.
+CHECKPOINT_DB = utils.getDatabaseName('mimic-checkpoints')
 
-def _sayit(irc, sid, userdict, channel, nick, text, action=False):
-    """Mimic core function."""
+def _resolve_nicks(irc, nicks):
+    """
+    Works out the IRC nick to use for each nick in the chatlogs, all in one pass. Returns a dict
+    mapping lowercased log nicks to IRC nicks; nicks that can't be made valid are left out.
+    """
+    taken = {irc.toLower(user.nick) for user in irc.users.copy().values()}
+    resolved = {}
+    for nick in nicks:
+        lowernick = irc.toLower(nick)
+        if lowernick in resolved:
+            continue
 
-    # Fix imperfections in the REGEX matching.
-    nick = nick.strip(('\x03\x02\x01'))
+        ircnick = nick.replace('/', '|')
+        if nick.startswith(tuple(string.digits)):
+            ircnick = '_' + ircnick
 
-    lowernick = irc.toLower(nick)
-    uid = userdict.get(lowernick)
-    log.debug('(%s) mimic: got UID %s for nick %s', irc.name, uid, nick)
-    if not uid:  # Nick doesn't exist; make a new client for it.
-        ircnick = nick
-        ircnick = ircnick.replace('/', '|')
-        if irc.nickToUid(nick):
+        if irc.toLower(ircnick) in taken:
             # Nick exists, but is not one of our temp users. Tag it with |mimic
             ircnick += MIMICSUFFIX
-
-        if nick.startswith(tuple(string.digits)):
-            ircnick = '_' + ircnick
+            # Different log nicks can still end up the same after the fixes above, so number
+            # any further duplicates.
+            count = 1
+            basenick = ircnick
+            while irc.toLower(ircnick) in taken:
+                count += 1
+                ircnick = '%s%s' % (basenick, count)
 
         if not utils.isNick(ircnick):
-            log.warning('(%s) mimic: Bad nick %s, ignoring text: <%s> %s', irc.name, ircnick, nick, text)
-            return userdict
+            log.warning('(%s) mimic: Bad nick %s, ignoring lines from %s', irc.name, ircnick, nick)
+            continue
+
+        taken.add(irc.toLower(ircnick))
+        resolved[lowernick] = ircnick
+    return resolved
 
+def _spawn_clients(irc, sid, channel, nicks):
+    """
+    Spawns a client for every resolved nick and joins them all to the channel, returning a dict
+    mapping lowercased log nicks to UIDs.
+    """
+    userdict = {}
+    for lowernick, ircnick in nicks.items():
         userdict[lowernick] = uid = irc.proto.spawnClient(ircnick, 'mimic', HOSTNAME, server=sid).uid
-        log.debug('(%s) mimic: spawning client %s for nick %s (really %s)', irc.name, uid, ircnick, nick)
-        irc.proto.join(uid, channel)
+        log.debug('(%s) mimic: spawning client %s for nick %s', irc.name, uid, ircnick)
+
+    uids = list(userdict.values())
+    # Not every protocol module splits long SJOINs, so keep each one to a sane length.
+    for pos in range(0, len(uids), SJOIN_CHUNK):
+        irc.proto.sjoin(sid, channel, [('', uid) for uid in uids[pos:pos+SJOIN_CHUNK]])
+    return userdict
+
+def _sayit(irc, userdict, channel, nick, text, action=False):
+    """Mimic core function."""
+    uid = userdict.get(irc.toLower(_clean_nick(nick)))
+    if not uid:
+        # This nick was left out when spawning clients.
+        log.debug('(%s) mimic: no client for nick %s, ignoring text: %s', irc.name, nick, text)
+        return
 
     if action:  # Format CTCP action
         text = '\x01ACTION %s\x01' % text
 
     irc.proto.message(uid, channel, text)
-    return userdict
+
+def _parse_line(line):
+    """
+    Parses a chatlog line into a (timestamp, sender, text, action) tuple, where timestamp is
+    the number of seconds since midnight. Returns None if the line isn't a chat line.
+    """
+    action = False  # Marks whether line is an action
+    match = CHAT_REGEX.search(line)
+    if not match:
+        match = ACTION_REGEX.search(line)
+        action = True
+
+    if match:
+        stamp, sender, text = match.group(1, 2, 3)
+        hours, minutes, seconds = map(int, stamp.split(':'))
+        return (hours * 3600 + minutes * 60 + seconds, sender, text, action)
+
+def _decode(line):
+    """Decodes a raw log line, ignoring any UnicodeDecodeError."""
+    return line.decode('utf-8', errors='replace').rstrip('\r\n')
+
+def _clean_nick(nick):
+    """Fix imperfections in the REGEX matching."""
+    return nick.strip('\x03\x02\x01')
+
+# Log indexes loaded during this session, by path.
+_indexes = {}
+# Locks serializing index loads and rebuilds, by path, so that replays of the same logs don't
+# build them twice.
+_index_locks = {}
+
+def _build_index(path, mtime, size):
+    """
+    Scans a log file and returns its index: the byte offset, line number and timestamp of each
+    chat line, along with the sorted list of nicks that speak in it.
+    """
+    index = {'version': INDEX_VERSION, 'mtime': mtime, 'size': size,
+             'offsets': [], 'lines': [], 'timestamps': []}
+    speakers = set()
+    offset = 0
+    with open(path, 'rb') as f:
+        for lineno, line in enumerate(f, 1):
+            parsed = _parse_line(_decode(line))
+            if parsed:
+                index['offsets'].append(offset)
+                index['lines'].append(lineno)
+                index['timestamps'].append(parsed[0])
+                speakers.add(_clean_nick(parsed[1]))
+            offset += len(line)
+
+    index['speakers'] = sorted(speakers)
+    return index
+
+def get_index(path):
+    """
+    Returns the index for the given log file, reusing the one stored next to it (in
+    <path>.mimicidx) unless the log's modification time or size have changed since.
+    """
+    with _index_locks.setdefault(path, threading.Lock()):
+        stat = os.stat(path)
+        mtime, size = stat.st_mtime_ns, stat.st_size
+
+        index = _indexes.get(path)
+        if index and index['mtime'] == mtime and index['size'] == size:
+            return index
+
+        idxpath = path + INDEX_SUFFIX
+        try:
+            with open(idxpath) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = None
+
+        # Index files missing any of the expected keys are rebuilt, the same as stale ones.
+        if not (isinstance(index, dict) and all(key in index for key in INDEX_KEYS) and
+                index['version'] == INDEX_VERSION and index['mtime'] == mtime and index['size'] == size):
+            log.debug('mimic: building index for log file %s', path)
+            index = _build_index(path, mtime, size)
+            _save_index(idxpath, index)
+
+        _indexes[path] = index
+        return index
+
+def _save_index(idxpath, index):
+    """
+    Writes an index file atomically, so that it is never read half-written (e.g. by another
+    PyLink instance replaying the same logs).
+    """
+    try:
+        # Hidden and ending in INDEX_SUFFIX, so that log globs leave it out.
+        fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(idxpath), prefix='.', suffix=INDEX_SUFFIX)
+    except OSError:
+        log.debug('mimic: could not save index %s, keeping it in memory only', idxpath, exc_info=True)
+        return
+
+    try:
+        with open(fd, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmppath, idxpath)
+    except OSError:
+        log.debug('mimic: could not save index %s, keeping it in memory only', idxpath, exc_info=True)
+        try:
+            os.unlink(tmppath)
+        except OSError:
+            pass
+
+def _load_checkpoints():
+    try:
+        with open(CHECKPOINT_DB) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _save_checkpoints(checkpoints):
+    try:
+        with open(CHECKPOINT_DB, 'w') as f:
+            json.dump(checkpoints, f)
+    except OSError:
+        log.warning('mimic: could not save replay checkpoints to %s', CHECKPOINT_DB, exc_info=True)
+
+# Guards reading and writing the checkpoint file.
+_checkpoint_lock = threading.Lock()
+
+class _SendBudget():
+    """Token bucket limiting how many lines all replays may send."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+
+    def take(self, now):
+        """
+        Takes a token if one is available and returns 0. Otherwise, returns the amount of
+        seconds until the next token is available.
+        """
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return (1 - self._tokens) / self.rate
+
+class _Scheduler():
+    """
+    Runs the steps of every mimic replay from a single timer thread.
+
+    Each scheduled function is called when its delay expires, and may return a new delay (in
+    seconds) to be called again, or None when it is finished. Calls are limited by a shared
+    send budget; when it runs out, waiting calls are served in the order they became due, so
+    that no replay can starve the others.
+    """
+
+    def __init__(self, rate=MAXRATE, burst=BURST):
+        self._budget = _SendBudget(rate, burst)
+        self._queue = []
+        self._counter = itertools.count()  # Tiebreaker for entries due at the same time
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def schedule(self, delay, func):
+        """Schedules func to be called after the given delay."""
+        with self._cond:
+            heapq.heappush(self._queue, (time.monotonic() + delay, next(self._counter), func))
+
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='mimic-scheduler', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def unschedule(self, func):
+        """Removes all pending calls to func."""
+        with self._cond:
+            self._queue = [entry for entry in self._queue if entry[2] != func]
+            heapq.heapify(self._queue)
+
+    def stop(self):
+        """Drops all pending calls and stops the scheduler thread."""
+        with self._cond:
+            self._queue.clear()
+            self._thread = None
+            self._cond.notify()
+
+    def _run(self):
+        thread = threading.current_thread()
+        while True:
+            with self._cond:
+                while self._thread is thread:
+                    if not self._queue:
+                        self._cond.wait()
+                        continue
+
+                    now = time.monotonic()
+                    remaining = self._queue[0][0] - now
+                    if remaining <= 0:
+                        remaining = self._budget.take(now)
+                        if remaining <= 0:
+                            break
+                    self._cond.wait(remaining)
+                else:
+                    # We've been stopped.
+                    return
+
+                _, _, func = heapq.heappop(self._queue)
+
+            try:
+                delay = func()
+            except Exception:
+                log.exception('mimic: error in replay step %s', func)
+                continue
+
+            if delay is not None:
+                self.schedule(delay, func)
+
+scheduler = _Scheduler()
+
+# Running replays, by ID.
+replays = {}
+_replay_ids = itertools.count(1)
+
+class _Replay():
+    """
+    Represents one mimic session: a set of log files replayed into a channel.
+
+    If speed is given, lines are sent at their original relative offsets divided by the speed
+    factor, with gaps longer than maxgap compressed down to it. Otherwise, lines are sent
+    LINEDELAY seconds apart.
+
+    The replay starts at the first chat line of the first log, unless one of start_time
+    (seconds since midnight), start_line (a line number in the first log) or checkpoint (a
+    dict with the log and byte offset a previous replay stopped at) is given.
+    """
+
+    def __init__(self, irc, channel, pattern, logs, speed=None, maxgap=MAXGAP,
+                 start_time=None, start_line=None, checkpoint=None):
+        self.id = next(_replay_ids)
+        self.irc = irc
+        self.sid = None
+        self.channel = channel
+        self.pattern = pattern
+        self.logs = logs
+        self.speed = speed
+        self.maxgap = maxgap
+        self.start_time = start_time
+        self.start_line = start_line
+        self.checkpoint = checkpoint
+
+        self.userdict = {}
+        self.speakers = set()
+        self.current_log = None
+        self.sent = 0
+        self.paused = False
+        self.ready = False
+
+        self._lines = None
+        self._line = None
+        self._parked = False  # Set when a paused replay has left the scheduler
+        self._done = False
+        # Serializes sending with pause/cancel requests from the command thread.
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<mimic replay %s on %s/%s>' % (self.id, self.irc.name, self.channel)
+
+    @property
+    def key(self):
+        """Returns the key this replay's checkpoint is stored under."""
+        return '%s/%s/%s' % (self.irc.name, self.channel, self.pattern)
+
+    def _find_start(self, indexes):
+        """Returns the position of the log and the byte offset to start replaying from."""
+        if self.checkpoint:
+            try:
+                return (self.logs.index(self.checkpoint['log']), self.checkpoint['offset'])
+            except ValueError:
+                log.warning('(%s) mimic: checkpoint log %s no longer matches %s, starting from the beginning',
+                            self.irc.name, self.checkpoint['log'], self.pattern)
+                return (0, 0)
+
+        index = indexes[0]
+        if self.start_time is not None:
+            # Logs are kept per day, so timestamps only increase within a log.
+            pos = bisect.bisect_left(index['timestamps'], self.start_time)
+        elif self.start_line is not None:
+            pos = bisect.bisect_left(index['lines'], self.start_line)
+        else:
+            return (0, 0)
+
+        if pos >= len(index['offsets']):
+            # Seeking past the end of the first log: start at the next one.
+            return (1, 0)
+        return (0, index['offsets'][pos])
+
+    def _read_logs(self, first, offset):
+        """
+        Yields (offset, timestamp, sender, text, action) tuples for each chat line in the logs,
+        starting at the given log and byte offset. The name of each log file is yielded
+        before its contents.
+        """
+        for item in self.logs[first:]:
+            yield item
+            with open(item, 'rb') as f:
+                f.seek(offset)
+                for line in f:
+                    parsed = _parse_line(_decode(line))
+                    if parsed:
+                        yield (offset,) + parsed
+                    offset += len(line)
+            offset = 0
+
+    def _next_line(self):
+        """Returns the next chat line to send, or None if the logs are exhausted."""
+        for entry in self._lines:
+            if isinstance(entry, str):
+                self.current_log = entry
+                self.irc.proto.notice(self.irc.pseudoclient.uid, self.channel,
+                                      'Beginning mimic of log file %s' % entry)
+            else:
+                return entry
+
+    def _delay(self, timestamp, nextline):
+        """Returns how long to wait between the line sent at timestamp and nextline."""
+        if self.speed is None or nextline is None:
+            return LINEDELAY
+
+        gap = nextline[1] - timestamp
+        if gap < 0:  # The log rolled over past midnight
+            gap += 86400
+        return min(gap, self.maxgap) / self.speed
+
+    def start(self):
+        """
+        Starts the replay. Log indexes are loaded (or built) in a separate thread, after which
+        the replay is handed off to the shared scheduler.
+        """
+        self.sid = self.irc.proto.spawnServer(SERVERNAME % self.id)
+        replays[self.id] = self
+        threading.Thread(target=self._prepare, name='mimic-prepare-%s' % self.id, daemon=True).start()
+
+    def _prepare(self):
+        try:
+            indexes = [get_index(item) for item in self.logs]
+
+            for index in indexes:
+                self.speakers.update(index['speakers'])
+            nicks = _resolve_nicks(self.irc, sorted(self.speakers))
+
+            with self._lock:
+                if self._done:  # Cancelled while we were indexing
+                    return
+                # Introduce everyone up front, so that the replay itself only has to send text.
+                self.userdict = _spawn_clients(self.irc, self.sid, self.channel, nicks)
+                self._lines = self._read_logs(*self._find_start(indexes))
+                self._line = self._next_line()
+                self.ready = True
+        except OSError as e:
+            log.warning('(%s) mimic: could not index logs for replay %s', self.irc.name, self.id, exc_info=True)
+            text = 'Failed to read logs for mimic: %s' % e
+        except Exception as e:
+            # Don't leave the replay (and its server) stuck in the indexing state.
+            log.exception('(%s) mimic: error preparing replay %s', self.irc.name, self.id)
+            text = 'Failed to start mimic: %s: %s' % (type(e).__name__, e)
+        else:
+            scheduler.schedule(0, self.step)
+            return
+
+        with self._lock:
+            if not self._done:
+                self._finish(text)
+
+    def step(self):
+        """Sends one line and returns the delay until the next, or None when finished."""
+        with self._lock:
+            if self._done:
+                return
+            elif self.paused:
+                # Drop out of the scheduler until we're resumed.
+                self._parked = True
+                return
+            elif self._line is None:
+                self._finish('Finished mimic of %s items' % len(self.logs))
+                return
+
+            _, timestamp, sender, text, action = self._line
+            try:
+                _sayit(self.irc, self.userdict, self.channel, sender, text, action=action)
+                self.sent += 1
+
+                self._line = self._next_line()
+            except Exception:
+                # Don't leave a dead replay (and its clients) behind if a line can't be sent or read.
+                log.exception('(%s) mimic: error in replay %s', self.irc.name, self.id)
+                self._finish('Stopped mimic of %s after an error' % (self.current_log or 'logs'))
+                return
+            return self._delay(timestamp, self._line)
+
+    def pause(self):
+        """Pauses the replay after the line currently being sent."""
+        with self._lock:
+            self.paused = True
+
+    def resume(self):
+        """Resumes a paused replay."""
+        with self._lock:
+            self.paused = False
+            if not self._parked:
+                # We haven't left the scheduler yet, so there's nothing to reschedule.
+                return
+            self._parked = False
+        scheduler.schedule(0, self.step)
+
+    def cancel(self):
+        """
+        Stops the replay immediately, removing its clients and server. Where the replay left
+        off is saved so that it can be continued later with --resume.
+        """
+        with self._lock:
+            if self._done:
+                return
+            if self._line is not None:
+                with _checkpoint_lock:
+                    checkpoints = _load_checkpoints()
+                    checkpoints[self.key] = {'log': self.current_log, 'offset': self._line[0]}
+                    _save_checkpoints(checkpoints)
+            self._finish('Cancelled mimic of %s' % (self.current_log or 'logs'))
+        scheduler.unschedule(self.step)
+
+    def _finish(self, text):
+        """Once we're done, SQUIT everyone to clean up automagically."""
+        self._done = True
+        replays.pop(self.id, None)
+        if self._lines is not None:
+            self._lines.close()
+        self.irc.proto.notice(self.irc.pseudoclient.uid, self.channel, text)
+        self.irc.proto.squit(self.irc.sid, self.sid)
+
+        if self._line is None and self.ready:
+            # We reached the end, so forget any old checkpoint.
+            with _checkpoint_lock:
+                checkpoints = _load_checkpoints()
+                if checkpoints.pop(self.key, None):
+                    _save_checkpoints(checkpoints)
+
+def die(irc=None):
+    for replay in list(replays.values()):
+        replay.cancel()
+    scheduler.stop()
+
+def _parse_time(text):
+    """Parses a HH:MM[:SS] time into the number of seconds since midnight."""
+    fields = text.split(':')
+    if len(fields) not in (2, 3):
+        raise ValueError("Invalid time %r: expected HH:MM or HH:MM:SS" % text)
+    hours, minutes, seconds = map(int, fields + ['0'] * (3 - len(fields)))
+    return hours * 3600 + minutes * 60 + seconds
+
+mimic_parser = utils.IRCParser()
+mimic_parser.add_argument('channel')
+mimic_parser.add_argument('logs')
+mimic_parser.add_argument('-s', '--speed', type=float)
+mimic_parser.add_argument('-g', '--max-gap', type=float, default=MAXGAP)
+mimic_start_group = mimic_parser.add_mutually_exclusive_group()
+mimic_start_group.add_argument('-t', '--start-time', type=_parse_time)
+mimic_start_group.add_argument('-l', '--start-line', type=int)
+mimic_start_group.add_argument('-r', '--resume', action='store_true')
 
 @utils.add_cmd
 def mimic(irc, source, args):
-    """<channel> <log glob>
+    """<channel> <log glob> [--speed <factor>] [--max-gap <seconds>] [--start-time <HH:MM[:SS]>|--start-line <line>|--resume]
+
+    Echoes chatlogs matching the log glob to the given channel. Home folders ("~") and environment variables ($HOME, etc.) are expanded in THAT order.
+
+    If --speed is given, lines are replayed with their original timing sped up by the given factor (e.g. 10 or 100). Idle gaps longer than --max-gap seconds (default 30) are shortened to that length before the speed factor is applied.
+
+    --start-time and --start-line skip ahead in the first log file matched. --resume continues a cancelled replay of the same glob to the same channel from where it stopped.
 
-    Echoes chatlogs matching the log glob to the given channel. Home folders ("~") and environment variables ($HOME, etc.) are expanded in THAT order."""
+    All replays share one send rate limit; see mimic-status for running replays."""
     irc.checkAuthenticated(source, allowOper=False)
+    args = mimic_parser.parse_args(args)
+
+    channel = args.channel
+    assert utils.isChannel(channel), "Invalid channel %s" % channel
+    channel = irc.toLower(channel)
+
+    if args.speed is not None and args.speed <= 0:
+        irc.error("The speed factor must be positive.")
+        return
+    elif args.max_gap < 0:
+        irc.error("The maximum gap must not be negative.")
+        return
+
+    # Expand variables in the path glob
+    pattern = os.path.expandvars(os.path.expanduser(args.logs))
+    # Leave out our own index files, in case the glob matches them too.
+    logs = sorted(item for item in glob.glob(pattern) if not item.endswith(INDEX_SUFFIX))
+    if not logs:
+        irc.error("No log files match %r." % pattern)
+        return
+
+    checkpoint = None
+    if args.resume:
+        with _checkpoint_lock:
+            checkpoint = _load_checkpoints().get('%s/%s/%s' % (irc.name, channel, pattern))
+        if not checkpoint:
+            irc.error("There is no cancelled replay of %r to %s to resume." % (pattern, channel))
+            return
+
+    replay = _Replay(irc, channel, pattern, logs, speed=args.speed, maxgap=args.max_gap,
+                     start_time=args.start_time, start_line=args.start_line, checkpoint=checkpoint)
+    replay.start()
+    irc.reply('Started mimic replay %s of %s log file(s) to %s.' % (replay.id, len(logs), channel))
+
+def _get_replays(irc, args):
+    """Returns the replays matching the replay ID (or "all") given in args."""
     try:
-        channel, logs = args[:2]
-    except ValueError:
-        irc.reply("Error: Not enough arguments. Needs 2: channel, log glob.")
+        target = args[0]
+    except IndexError:
+        irc.error("Not enough arguments. Needs 1: replay ID (or 'all').")
+        return []
+
+    if target.lower() == 'all':
+        return list(replays.values())
+
+    try:
+        return [replays[int(target)]]
+    except (ValueError, KeyError):
+        irc.error("No such replay %r. See mimic-status for running replays." % target)
+        return []
+
+def mimic_status(irc, source, args):
+    """takes no arguments.
+
+    Lists running mimic replays."""
+    irc.checkAuthenticated(source, allowOper=False)
+    if not replays:
+        irc.reply("No mimic replays are running.")
         return
-    else:
-        assert utils.isChannel(channel), "Invalid channel %s" % channel
-        channel = irc.toLower(channel)
-
-        # Expand variables in the path glob
-        logs = os.path.expandvars(os.path.expanduser(logs))
-
-    mysid = irc.proto.spawnServer(HOSTNAME)
-    logs = sorted(glob.glob(logs))
-
-    def talk():
-        userdict = {}
-        for item in logs:
-            irc.proto.notice(irc.pseudoclient.uid, channel, 'Beginning mimic of log file %s' % item)
-            with open(item, errors='replace') as f:  # errors='replace' ignores UnicodeDecodeError
-                for line in f.readlines():
-                    action = False  # Marks whether line is an action
-                    match = CHAT_REGEX.search(line)
-                    actionmatch = ACTION_REGEX.search(line)
-
-                    if actionmatch:
-                        action = True
-
-                    # Only one of the two matches need to exist for the check below
-                    match = match or actionmatch
-
-                    if match:
-                        sender, text = match.group(1, 2)
-                        # Update the user dict returned by _sayit(), which automatically spawns users
-                        # as they're seen.
-                        userdict = _sayit(irc, mysid, userdict, channel,
-                                          sender, text, action=action)
-
-                # Pause for a bit to prevent excess flood.
-                time.sleep(LINEDELAY)
+
+    for replay in sorted(replays.values(), key=lambda r: r.id):
+        if not replay.ready:
+            state = 'indexing'
+        elif replay.paused:
+            state = 'paused'
         else:
-            # Once we're done, SQUIT everyone to clean up automagically.
-            irc.proto.notice(irc.pseudoclient.uid, channel, 'Finished mimic of %s items' % len(logs))
-            irc.proto.squit(irc.sid, mysid)
+            state = 'running'
+        # Users spawned, out of the speakers found in the log indexes.
+        irc.reply('\x02%s\x02: %s/%s, %s, %s line(s) sent, %s/%s user(s), %s, on %s (%s log file(s))' %
+                  (replay.id, replay.irc.name, replay.channel, state, replay.sent,
+                   len(replay.userdict), len(replay.speakers),
+                   'speed %sx' % replay.speed if replay.speed else 'fixed delay',
+                   replay.current_log or 'nothing yet', len(replay.logs)))
+utils.add_cmd(mimic_status, 'mimic-status')
 
-    threading.Thread(target=talk).start()
+def mimic_pause(irc, source, args):
+    """<replay ID|all>
 
+    Pauses the given mimic replay, or all of them."""
+    irc.checkAuthenticated(source, allowOper=False)
+    targets = _get_replays(irc, args)
+    for replay in targets:
+        replay.pause()
+    if targets:
+        irc.reply('Paused %s replay(s).' % len(targets))
+utils.add_cmd(mimic_pause, 'mimic-pause')
+
+def mimic_resume(irc, source, args):
+    """<replay ID|all>
+
+    Resumes the given paused mimic replay, or all of them. To continue a cancelled replay, use 'mimic' with --resume instead."""
+    irc.checkAuthenticated(source, allowOper=False)
+    targets = _get_replays(irc, args)
+    for replay in targets:
+        replay.resume()
+    if targets:
+        irc.reply('Resumed %s replay(s).' % len(targets))
+utils.add_cmd(mimic_resume, 'mimic-resume')
+
+def mimic_cancel(irc, source, args):
+    """<replay ID|all>
+
+    Cancels the given mimic replay, or all of them, removing their clients immediately. Cancelled replays can be continued later with 'mimic ... --resume'."""
+    irc.checkAuthenticated(source, allowOper=False)
+    targets = _get_replays(irc, args)
+    for replay in targets:
+        replay.cancel()
+    if targets:
+        irc.reply('Cancelled %s replay(s).' % len(targets))
+utils.add_cmd(mimic_cancel, 'mimic-cancel')
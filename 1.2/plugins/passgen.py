@@ -5,11 +5,52 @@ passgen.py: Generates passwords/random strings given input criteria.
 __authors__ = [('Ken Spencer (Iota)', 'iota@electrocode.net')]
 __version__ = '0.1'
 
-from pylinkirc import utils
+from pylinkirc import utils, conf
 from pylinkirc.log import log
 
+import random
+import functools
+import threading
+
 from strgen import StringGenerator as sg
 
+# How many compiled templates to keep around.
+TEMPLATE_CACHE_SIZE = 128
+# Maximum amount of strings passgen-bulk may generate at once.
+BULK_MAX = conf.conf.get('passgen', {}).get('bulk_max', 1000)
+# Maximum length of each reply line sent by passgen-bulk.
+CHUNK_LENGTH = 400
+DEFAULT_TEMPLATE = "[\\c\\u\\d\\p]"
+DEFAULT_LENGTH = 15
+# Template code sets (and characters) that can produce whitespace.
+WHITESPACE_CODES = ('\\s', '\\W', '\\r', ' ')
+
+def _randomizer():
+    """Returns a cryptographically secure random number generator for StringGenerator."""
+    # Newer StringGenerator versions ship a buffered os.urandom() generator, which is much
+    # faster for bulk generation than SystemRandom's one syscall per value.
+    if hasattr(sg, 'BufferedSecureRandom'):
+        return sg.BufferedSecureRandom()
+    return random.SystemRandom()
+
+# One generator (and entropy buffer) is shared by every compiled template, so rendering is
+# serialized.
+randomizer = _randomizer()
+render_lock = threading.Lock()
+
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def _compile(template):
+    """Parses a template once, so that later uses only have to render it."""
+    return sg(template, randomizer=randomizer)
+
+def _render(template, count=None):
+    """Renders a template once, or count unique times if count is given."""
+    generator = _compile(template)
+    with render_lock:
+        if count is None:
+            return generator.render()
+        return generator.render_list(count, unique=True)
+
 def passgen(irc, source, args):
     r"""[length] [template]
     The template is in format '[codesets]'. If something like the following was required.
@@ -76,19 +117,74 @@ def passgen(irc, source, args):
         if lengtharg == "" and template == "":
             template = "[\c\\u\d]"
             template = template + "{%s}" % length
-            result = sg("%s" % template).render()
+            result = _render(template)
         if lengtharg == 0 and template == "":
             template = "[\c\\u\d\p]"
             template = template + "{%s}" % length
-            result = sg("%s" % template).render()
+            result = _render(template)
         elif lengtharg > 0 and template == "":
             template = "[\c\\u\d\p]"
-            result = sg("%s{%s}" % (template, lengtharg)).render()
+            result = _render("%s{%s}" % (template, lengtharg))
         elif lengtharg == 0 and template != "":
-            result = sg("%s" % template).render()
+            result = _render(template)
         else:
             irc.error("part of your input was invalid")
 
     password = result
     irc.reply(password, private=True)
 utils.add_cmd(passgen, "passgen")
+
+def passgen_bulk(irc, source, args):
+    r"""<count> [template]
+    Generates <count> unique strings from one template in a single call, for provisioning batches of passwords. The template uses the same format as 'passgen', and defaults to 15 characters of '[\c\u\d\p]'.
+    Results are sent privately, packed several per line and separated by spaces, so templates that can produce whitespace (\s, \W, \r) are refused."""
+    try:
+        count = int(args[0])
+    except IndexError:
+        irc.error("Not enough arguments. Needs 1-2: count, template (optional).", private=True)
+        return
+    except ValueError:
+        irc.error("count must be a positive integer", private=True)
+        return
+
+    if not 0 < count <= BULK_MAX:
+        irc.error("count must be between 1 and %s" % BULK_MAX, private=True)
+        return
+
+    try:
+        template = args[1]
+    except IndexError:
+        template = "%s{%s}" % (DEFAULT_TEMPLATE, DEFAULT_LENGTH)
+
+    try:
+        results = _render(template, count)
+    except sg.SyntaxError as e:
+        irc.error("invalid template: %s" % e, private=True)
+        return
+    except sg.UniquenessError:
+        irc.error("template can't produce %s unique strings" % count, private=True)
+        return
+
+    # Results are packed several per line, separated by spaces, so they must not contain
+    # whitespace themselves or be longer than a line.
+    if any(len(result) > CHUNK_LENGTH for result in results):
+        irc.error("results longer than %s characters aren't supported in bulk mode" % CHUNK_LENGTH, private=True)
+        return
+    elif any(code in template for code in WHITESPACE_CODES) or any(len(result.split()) != 1 for result in results):
+        irc.error(r"templates that can produce whitespace (e.g. \s, \W or \r) aren't supported in bulk mode",
+                  private=True)
+        return
+
+    # Pack results into lines of bounded length, instead of sending one line each.
+    chunk = []
+    length = 0
+    for result in results:
+        if chunk and length + len(result) + 1 > CHUNK_LENGTH:
+            irc.reply(" ".join(chunk), private=True)
+            chunk = []
+            length = 0
+        chunk.append(result)
+        length += len(result) + 1
+    if chunk:
+        irc.reply(" ".join(chunk), private=True)
+utils.add_cmd(passgen_bulk, "passgen-bulk")
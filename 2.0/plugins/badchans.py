@@ -20,8 +20,12 @@ badchans:
     # The DNSBL submission comment to use. Defaults to the value in DEFAULT_DNSBL_REASON below.
     #dnsbl_reason: "You did the unspeakable!"
 
-    # Max threads count for DNSBL submission (defaults to 5)
-    #max_threads: 5
+    # Max threads count for DNSBL submission (defaults to 10)
+    #max_threads: 10
+
+    # Max number of DNSBL submissions waiting for a thread (defaults to 1000). Submissions beyond
+    # this are dropped, and retried the next time those IPs join a bad channel.
+    #max_queue: 1000
 
 servers:
     net1:
@@ -43,35 +47,43 @@ servers:
 
 from pylinkirc import utils, conf, world
 from pylinkirc.log import log
+from pylinkirc.plugins import hookprof, workerpool
 
-import concurrent.futures
 import ipaddress
 import json
 import time
+from xml.etree import ElementTree
 
 import requests
 import cachetools
 
 MAX_THREADS = conf.conf.get('badchans', {}).get('max_threads', 10)
+MAX_QUEUE = conf.conf.get('badchans', {}).get('max_queue', workerpool.DEFAULT_MAX_QUEUE)
 pool = None
 seen_ips = None
 
 def main(irc=None):
     global pool, seen_ips
-    pool = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_THREADS)
+    pool = workerpool.register('badchans', max_threads=MAX_THREADS, max_queue=MAX_QUEUE)
     seen_ips = cachetools.LRUCache(maxsize=2048)
 
 def die(irc=None):
     if pool is not None:
-        pool.shutdown(wait=False)
+        pool.drain()
 
 DEFAULT_DNSBL_REASON = "A user o" + "n this host" + " joined an IR" + "C spa" + "mtra" + "p channel."
 
+# Maximum number of IPs sent to a DNSBL in one request; larger batches (e.g. from a netjoin) are
+# split up.
+DNSBL_BATCH_SIZE = 100
+
 DRONEBL_TYPE = 3  # IRC spam drone
-def _submit_dronebl(irc, ip, apikey, nickuserhost=None):
+def _submit_dronebl(irc, entries, apikey):
+    """Submits a batch of (ip, nickuserhost) pairs to DroneBL in one request."""
     reason = irc.get_service_option('badchans', 'dnsbl_reason', DEFAULT_DNSBL_REASON)
 
-    request = '<add ip="%s" type="%s" comment="%s" />' % (ip, DRONEBL_TYPE, reason)
+    request = ''.join('<add ip="%s" type="%s" comment="%s" />' % (ip, DRONEBL_TYPE, reason)
+                      for ip, _ in entries)
     xml_data = '<?xml version="1.0"?><request key="%s">%s</request>' % (apikey, request)
     headers = {'Content-Type': 'text/xml'}
 
@@ -83,13 +95,37 @@ def _submit_dronebl(irc, ip, apikey, nickuserhost=None):
     dronebl_response = r.text
 
     log.debug('(%s) badchans: got response from dronebl: %s', irc.name, dronebl_response)
-    if '<success' in dronebl_response:
-        log.info('(%s) badchans: got success for DroneBL on %s (%s)', irc.name, ip, nickuserhost or 'some n!u@h')
-    else:
+    try:
+        response = ElementTree.fromstring(dronebl_response)
+    except ElementTree.ParseError:
+        response = None
+    if response is None or response.find('success') is None:
         log.warning('(%s) badchans: dronebl submission error: %s', irc.name, dronebl_response)
+        return
+
+    # A batched request can partly fail: DroneBL then sends a <warning> or <error> for the
+    # affected IPs alongside the <success>, so check each IP against those.
+    failed = set()
+    for element in response:
+        if element.tag == 'success':
+            continue
+        log.warning('(%s) badchans: dronebl submission %s: %s', irc.name, element.tag,
+                    ElementTree.tostring(element, encoding='unicode').strip())
+        mentioned = set()
+        for child in element.iter():
+            mentioned.update(child.attrib.values())
+            mentioned.update((child.text or '').split())
+        failed.update(ip for ip, _ in entries if ip in mentioned)
+
+    succeeded = ['%s (%s)' % (ip, nuh) for ip, nuh in entries if ip not in failed]
+    if succeeded:
+        log.info('(%s) badchans: got success for DroneBL on %s', irc.name, ', '.join(succeeded))
+    if failed:
+        log.warning('(%s) badchans: dronebl did not accept %s', irc.name, ', '.join(sorted(failed)))
 
 DNSBLIM_TYPE = 5  # Abusive Hosts
-def _submit_dnsblim(irc, ip, apikey, nickuserhost=None):
+def _submit_dnsblim(irc, entries, apikey):
+    """Submits a batch of (ip, nickuserhost) pairs to DNSBL.im in one request."""
     reason = irc.get_service_option('badchans', 'dnsbl_reason', DEFAULT_DNSBL_REASON)
 
     request = {
@@ -98,7 +134,7 @@ def _submit_dnsblim(irc, ip, apikey, nickuserhost=None):
            'ip': ip,
            'type': str(DNSBLIM_TYPE),
            'reason': reason,
-       }],
+       } for ip, _ in entries],
     }
     headers = {'Content-Type': 'application/json'}
 
@@ -114,6 +150,10 @@ DEFAULT_BAN_DURATION = '24h'
 def handle_join(irc, source, command, args):
     """
     killonjoin JOIN listener.
+
+    A JOIN can carry many users at once (e.g. during a netjoin), so users are first sorted into
+    groups in a single pass, and the resulting warnings, kills/bans and DNSBL submissions are
+    then sent together.
     """
     # Ignore our own clients and other Ulines
     if irc.is_privileged_service(source) or irc.is_internal_server(source):
@@ -126,79 +166,103 @@ def handle_join(irc, source, command, args):
         log.error("(%s) badchans: the 'badchans' option must be a list of strings, not a %s", irc.name, type(badchans))
         return
 
+    channel = args['channel']
+    if not any(irc.match_text(badchan, channel) for badchan in badchans):
+        return
+
     use_kline = irc.get_service_option('badchans', 'use_kline', False)
     kline_duration = irc.get_service_option('badchans', 'kline_duration', DEFAULT_BAN_DURATION)
     try:
         kline_duration = utils.parse_duration(kline_duration)
     except ValueError:
         log.warning('(%s) badchans: invalid kline duration %s', irc.name, kline_duration, exc_info=True)
-        kline_duration = DEFAULT_BAN_DURATION
+        kline_duration = utils.parse_duration(DEFAULT_BAN_DURATION)
+
+    exempt_hosts = set(conf.conf.get('badchans', {}).get('exempt_hosts', [])) | \
+                   set(irc.serverdata.get('badchans_exempt_hosts', []))
+
+    asm_uid = None
+    # Try to kill from the antispam service if available
+    if 'antispam' in world.services:
+        asm_uid = world.services['antispam'].uids.get(irc.name)
+
+    # Sort everyone into groups first.
+    nonglobal = []
+    exempt = []
+    opers = []
+    punish = []  # (uid, ip) pairs
+    for user in args['users']:
+        try:
+            ip = irc.users[user].ip
+            ipa = ipaddress.ip_address(ip)
+        except (KeyError, ValueError):
+            log.error("(%s) badchans: could not obtain IP of user %s", irc.name, user)
+            continue
+
+        if not ipa.is_global:
+            nonglobal.append(user)
+        elif any(irc.match_host(glob, user) for glob in exempt_hosts):
+            log.info("(%s) badchans: ignoring exempt user %s on %s (%s)", irc.name, irc.get_hostmask(user), channel, ip)
+            exempt.append(user)
+        elif irc.is_oper(user):
+            opers.append(user)
+        else:
+            punish.append((user, ip))
+
+    sender = asm_uid or irc.pseudoclient.uid
+    for users, text in ((nonglobal, "Warning: %s kills unopered users, but non-public addresses are exempt."),
+                        (exempt, "Warning: %s kills unopered users, but your host is exempt."),
+                        (opers, "Warning: %s kills unopered users!")):
+        for user in users:
+            irc.msg(user, text % channel, notice=True, source=sender)
+
+    if not punish:
+        return
 
-    channel = args['channel']
-    for badchan in badchans:
-        if irc.match_text(badchan, channel):
-            asm_uid = None
-            # Try to kill from the antispam service if available
-            if 'antispam' in world.services:
-                asm_uid = world.services['antispam'].uids.get(irc.name)
-
-            for user in args['users']:
-                try:
-                    ip = irc.users[user].ip
-                    ipa = ipaddress.ip_address(ip)
-                except (KeyError, ValueError):
-                    log.error("(%s) badchans: could not obtain IP of user %s", irc.name, user)
-                    continue
-                nuh = irc.get_hostmask(user)
-
-                exempt_hosts = set(conf.conf.get('badchans', {}).get('exempt_hosts', [])) | \
-                             set(irc.serverdata.get('badchans_exempt_hosts', []))
-
-                if not ipa.is_global:
-                    irc.msg(user, "Warning: %s kills unopered users, but non-public addresses are exempt." % channel,
-                            notice=True,
-                            source=asm_uid or irc.pseudoclient.uid)
-                    continue
-
-                if exempt_hosts:
-                    skip = False
-                    for glob in exempt_hosts:
-                        if irc.match_host(glob, user):
-                            log.info("(%s) badchans: ignoring exempt user %s on %s (%s)", irc.name, nuh, channel, ip)
-                            irc.msg(user, "Warning: %s kills unopered users, but your host is exempt." % channel,
-                                    notice=True,
-                                    source=asm_uid or irc.pseudoclient.uid)
-                            skip = True
-                            break
-                    if skip:
-                        continue
-
-                if irc.is_oper(user):
-                    irc.msg(user, "Warning: %s kills unopered users!" % channel,
-                            notice=True,
-                            source=asm_uid or irc.pseudoclient.uid)
-                else:
-                    log.info('(%s) badchans: punishing user %s (server: %s) for joining channel %s',
-                             irc.name, nuh, irc.get_friendly_name(irc.get_server(user)), channel)
-                    if use_kline:
-                        irc.set_server_ban(asm_uid or irc.sid, kline_duration, host=ip, reason=REASON)
-                    else:
-                        irc.kill(asm_uid or irc.sid, user, REASON)
-
-                    if ip not in seen_ips:
-                        dronebl_key = irc.get_service_option('badchans', 'dronebl_key')
-                        if dronebl_key:
-                            log.info('(%s) badchans: submitting IP %s (%s) to DroneBL', irc.name, ip, nuh)
-                            pool.submit(_submit_dronebl, irc, ip, dronebl_key, nuh)
-
-                        dnsblim_key = irc.get_service_option('badchans', 'dnsblim_key')
-                        if dnsblim_key:
-                            log.info('(%s) badchans: submitting IP %s (%s) to DNSBL.im', irc.name, ip, nuh)
-                            pool.submit(_submit_dnsblim, irc, ip, dnsblim_key, nuh)
-
-                        seen_ips[ip] = time.time()
-
-                    else:
-                        log.debug('(%s) badchans: ignoring already submitted IP %s', irc.name, ip)
-
-utils.add_hook(handle_join, 'JOIN')
+    # Look up hostmasks before anyone is killed.
+    punish = [(user, ip, irc.get_hostmask(user)) for user, ip in punish]
+    banned_ips = set()
+    new_ips = {}  # IP => nick!user@host
+    for user, ip, nuh in punish:
+        log.info('(%s) badchans: punishing user %s (server: %s) for joining channel %s',
+                 irc.name, nuh, irc.get_friendly_name(irc.get_server(user)), channel)
+        if use_kline:
+            # One ban covers every user from the same IP.
+            if ip not in banned_ips:
+                irc.set_server_ban(asm_uid or irc.sid, kline_duration, host=ip, reason=REASON)
+                banned_ips.add(ip)
+        else:
+            irc.kill(asm_uid or irc.sid, user, REASON)
+
+        if ip in seen_ips:
+            log.debug('(%s) badchans: ignoring already submitted IP %s', irc.name, ip)
+        else:
+            new_ips.setdefault(ip, nuh)
+
+    submitters = []
+    dronebl_key = irc.get_service_option('badchans', 'dronebl_key')
+    if dronebl_key:
+        submitters.append(('DroneBL', _submit_dronebl, dronebl_key))
+    dnsblim_key = irc.get_service_option('badchans', 'dnsblim_key')
+    if dnsblim_key:
+        submitters.append(('DNSBL.im', _submit_dnsblim, dnsblim_key))
+
+    new_ips = list(new_ips.items())
+    for pos in range(0, len(new_ips), DNSBL_BATCH_SIZE):
+        batch = new_ips[pos:pos+DNSBL_BATCH_SIZE]
+        queued = True
+        for name, func, apikey in submitters:
+            log.info('(%s) badchans: submitting %s IP(s) to %s', irc.name, len(batch), name)
+            queued = pool.submit(func, irc, batch, apikey) and queued
+
+        # Only remember IPs once they're on their way, so that ones dropped by a full (or
+        # draining) queue are submitted again the next time they show up.
+        if queued:
+            now = time.time()
+            for ip, _ in batch:
+                seen_ips[ip] = now
+        else:
+            log.warning('(%s) badchans: could not queue DNSBL submission of %s IP(s); they will be '
+                        'submitted again the next time they join', irc.name, len(batch))
+
+utils.add_hook(hookprof.profiled(handle_join), 'JOIN')
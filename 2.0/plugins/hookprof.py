@@ -0,0 +1,174 @@
+"""
+hookprof.py: Opt-in latency profiling for contrib plugin hook handlers.
+
+This is a support module: plugins wrap their hook handlers with hookprof.profiled() when
+registering them, so it does not need to be listed under "plugins:". While profiling is off,
+wrapped handlers only pay for one extra function call and flag check.
+"""
+
+# Config options (all optional):
+'''
+hookprof:
+    # Whether to start profiling on load. Profiling can also be toggled with the 'hookprof' command.
+    enabled: false
+
+    # If set, a summary of hook latencies is logged every this many seconds while profiling is on.
+    #dump_interval: 300
+'''
+
+import collections
+import functools
+import threading
+import time
+
+from pylinkirc import conf, utils
+from pylinkirc.coremods import permissions
+from pylinkirc.log import log
+
+enabled = conf.conf.get('hookprof', {}).get('enabled', False)
+DUMP_INTERVAL = conf.conf.get('hookprof', {}).get('dump_interval')
+# How many recent calls per hook are kept for percentiles.
+SAMPLE_SIZE = 1024
+# How many of the slowest calls per hook to remember, and for how long (in seconds).
+SLOWEST_COUNT = 3
+SLOWEST_WINDOW = 600
+# Maximum length of the event arguments stored for slow calls.
+ARGS_LENGTH = 200
+
+class HookStats():
+    """Latency statistics for one hook handler on one network."""
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.samples = collections.deque(maxlen=SAMPLE_SIZE)
+        # (latency, timestamp, command, source, args) tuples for the slowest recent calls.
+        self.slowest = []
+
+    def record(self, latency, command, source, args):
+        self.calls += 1
+        self.total += latency
+        self.samples.append(latency)
+
+        now = time.time()
+        self.slowest = [entry for entry in self.slowest if now - entry[1] < SLOWEST_WINDOW]
+        if len(self.slowest) < SLOWEST_COUNT or latency > self.slowest[-1][0]:
+            # Only format the arguments for calls that actually make the list.
+            self.slowest.append((latency, now, command, source, repr(args)[:ARGS_LENGTH]))
+            self.slowest.sort(key=lambda entry: entry[0], reverse=True)
+            del self.slowest[SLOWEST_COUNT:]
+
+    def percentile(self, fraction):
+        samples = sorted(self.samples)
+        if not samples:
+            return 0.0
+        return samples[min(int(len(samples) * fraction), len(samples) - 1)]
+
+# HookStats instances, by (network name, hook name).
+stats = collections.defaultdict(HookStats)
+stats_lock = threading.Lock()
+
+def profiled(func):
+    """
+    Wraps a hook handler so that its latency is recorded while profiling is enabled. The wrapper
+    keeps func's name and module, so PyLink still removes it when the plugin is unloaded.
+    """
+    name = '%s.%s' % (func.__module__.rsplit('.', 1)[-1], func.__name__)
+
+    @functools.wraps(func)
+    def wrapper(irc, source, command, args):
+        if not enabled:
+            return func(irc, source, command, args)
+
+        start = time.perf_counter()
+        try:
+            return func(irc, source, command, args)
+        finally:
+            latency = time.perf_counter() - start
+            with stats_lock:
+                stats[(irc.name, name)].record(latency, command, source, args)
+    return wrapper
+
+def _format_ms(seconds):
+    return '%.2fms' % (seconds * 1000)
+
+def _summarize(network=None):
+    """Returns a summary line for each profiled hook, slowest (by total time) first."""
+    lines = []
+    with stats_lock:
+        entries = sorted(stats.items(), key=lambda item: item[1].total, reverse=True)
+        for (netname, name), hookstats in entries:
+            if network and netname != network:
+                continue
+            line = '%s/%s: %s call(s), %s total, avg %s, p50 %s, p95 %s, p99 %s' % (
+                netname, name, hookstats.calls, _format_ms(hookstats.total),
+                _format_ms(hookstats.total / hookstats.calls), _format_ms(hookstats.percentile(0.5)),
+                _format_ms(hookstats.percentile(0.95)), _format_ms(hookstats.percentile(0.99)))
+            if hookstats.slowest:
+                latency, _, command, source, args = hookstats.slowest[0]
+                line += '; slowest recent: %s (%s from %s: %s)' % (_format_ms(latency), command, source, args)
+            lines.append(line)
+    return lines
+
+_dumper = None
+_dumper_stop = None
+
+def _dump_loop(stop):
+    while not stop.wait(DUMP_INTERVAL):
+        for line in _summarize():
+            log.info('hookprof: %s', line)
+
+def _start_dumper():
+    """Starts logging periodic summaries, if dump_interval is set."""
+    global _dumper, _dumper_stop
+    if DUMP_INTERVAL and _dumper is None:
+        # Each thread gets its own stop event, so that one still winding down can't be revived.
+        _dumper_stop = threading.Event()
+        _dumper = threading.Thread(target=_dump_loop, args=(_dumper_stop,), name='hookprof-dump', daemon=True)
+        _dumper.start()
+
+def _stop_dumper():
+    """Stops logging periodic summaries."""
+    global _dumper
+    if _dumper is not None:
+        _dumper_stop.set()
+        _dumper = None
+
+if enabled:
+    _start_dumper()
+
+@utils.add_cmd
+def hookprof(irc, source, args):
+    """[on|off|reset|<network>]
+
+    Shows call counts and latency percentiles for profiled plugin hook handlers, along with the arguments of the slowest recent call, optionally limited to one network.
+    "on" and "off" toggle profiling, and "reset" clears all recorded statistics."""
+    global enabled
+    try:
+        action = args[0]
+    except IndexError:
+        action = None
+
+    if action in ('on', 'off', 'reset'):
+        permissions.check_permissions(irc, source, ['hookprof.manage'])
+        if action == 'reset':
+            with stats_lock:
+                stats.clear()
+            irc.reply("Hook statistics cleared.")
+        else:
+            enabled = action == 'on'
+            if enabled:
+                _start_dumper()
+            else:
+                _stop_dumper()
+            irc.reply("Hook profiling is now %s." % ('enabled' if enabled else 'disabled'))
+        return
+
+    permissions.check_permissions(irc, source, ['hookprof.view'])
+    lines = _summarize(action)
+    if not lines:
+        irc.reply("No hook statistics recorded%s. Profiling is currently %s." %
+                  (' for %s' % action if action else '', 'enabled' if enabled else 'disabled'))
+        return
+    for line in lines:
+        irc.reply(line, private=True)
@@ -16,6 +16,7 @@ servers:
 from pylinkirc import utils, world, conf
 from pylinkirc.log import log
 from pylinkirc.coremods import permissions
+from pylinkirc.plugins import hookprof
 
 def _should_enforce(irc, source, args):
     exemptions = irc.get_service_option('operlock', 'exempt_hosts', default=None) or []
@@ -53,7 +54,7 @@ def handle_part(irc, source, command, args):
             else:
                 log.warning('(%s) Force join is not supported on this IRCd %r!', irc.name, irc.protoname)
 
-utils.add_hook(handle_part, 'PART')
+utils.add_hook(hookprof.profiled(handle_part), 'PART')
 
 DEOPER_KICK_REASON = 'User has deopered'
 def handle_mode(irc, source, command, args):
@@ -74,4 +75,4 @@ def handle_mode(irc, source, command, args):
                 else:
                     irc.kick(irc.sid, source, channel, DEOPER_KICK_REASON)
 
-utils.add_hook(handle_mode, 'MODE')
+utils.add_hook(hookprof.profiled(handle_mode), 'MODE')
@@ -5,6 +5,10 @@
 sshbl:
     # Defaults to 0. -5 is safer, -10 will only block really old hosts like dropbear 0.5x
     threshold: 0
+    # Max threads count for scanning (defaults to 10), and max number of scans waiting for a
+    # thread (defaults to 1000). Scans beyond this are skipped.
+    max_threads: 10
+    max_queue: 1000
     reason: "specify a kill reason"
     exempt_hosts:
         # E.g. to exempt SASL users
@@ -16,7 +20,6 @@ try:
     from sshbl import sshbl
 except ImportError:
     raise ImportError("sshbl is not installed - get it at https://github.com/jlu5/sshbl")
-import concurrent.futures
 import ipaddress
 import logging
 
@@ -25,17 +28,19 @@ logging.getLogger("sshbl").setLevel(logging.WARNING)
 
 from pylinkirc.log import log
 from pylinkirc import utils, conf
+from pylinkirc.plugins import hookprof, workerpool
 
 MAX_THREADS = conf.conf.get('sshbl', {}).get('max_threads', 10)
+MAX_QUEUE = conf.conf.get('sshbl', {}).get('max_queue', workerpool.DEFAULT_MAX_QUEUE)
 pool = None
 
 def main(irc=None):
     global pool
-    pool = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_THREADS)
+    pool = workerpool.register('sshbl', max_threads=MAX_THREADS, max_queue=MAX_QUEUE)
 
 def die(irc=None):
     if pool is not None:
-        pool.shutdown(wait=False)
+        pool.drain()
 
 def _check_connection(irc, args):
     ip = args['ip']
@@ -75,4 +80,4 @@ def handle_uid(irc, source, command, args):
                 return
     pool.submit(_check_connection, irc, args)
 
-utils.add_hook(handle_uid, 'UID')
+utils.add_hook(hookprof.profiled(handle_uid), 'UID')
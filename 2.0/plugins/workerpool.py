@@ -0,0 +1,206 @@
+"""
+workerpool.py: Shared, bounded worker threads for contrib plugins.
+
+This is a support module: plugins such as badchans and pylink_sshbl import it themselves, so it
+does not need to be listed under "plugins:". Each plugin registers its own queue with a thread
+quota and a maximum queue length. On die(), plugins drain their queue for up to drain_timeout
+seconds; jobs still queued after that are held and resumed when the plugin is loaded again.
+"""
+
+# Config options (all optional):
+'''
+workerpool:
+    # How long (in seconds) plugins wait for queued jobs to finish when unloading. Defaults to 5.
+    drain_timeout: 5
+'''
+
+import collections
+import sys
+import threading
+import time
+
+from pylinkirc import conf, utils
+from pylinkirc.coremods import permissions
+from pylinkirc.log import log
+
+DRAIN_TIMEOUT = conf.conf.get('workerpool', {}).get('drain_timeout', 5)
+DEFAULT_MAX_THREADS = 10
+DEFAULT_MAX_QUEUE = 1000
+# Idle worker threads exit after this many seconds.
+IDLE_TIMEOUT = 60
+
+# Registered queues, by plugin name. This module stays imported while the plugins using it are
+# reloaded, so queues (and any jobs held in them) outlive individual plugin instances.
+queues = {}
+queues_lock = threading.Lock()
+
+_Job = collections.namedtuple('_Job', 'func args kwargs submitted')
+
+class WorkerQueue():
+    """Bounded job queue with its own pool of worker threads, belonging to one plugin."""
+
+    def __init__(self, name, max_threads=DEFAULT_MAX_THREADS, max_queue=DEFAULT_MAX_QUEUE):
+        self.name = name
+        self.max_threads = max_threads
+        self.max_queue = max_queue
+
+        self._jobs = collections.deque()
+        self._cond = threading.Condition()
+        self._threads = 0
+        self._idle = 0
+        # Cleared while the owning plugin is unloading, so that new jobs are refused.
+        self._accepting = True
+        # Set once a drain has timed out: queued jobs are held until the plugin is reloaded.
+        self._held = False
+
+        # Counters shown by the 'workerstats' command.
+        self.running = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_runtime = 0.0
+
+    def __repr__(self):
+        return '<WorkerQueue %s>' % self.name
+
+    @property
+    def depth(self):
+        return len(self._jobs)
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Queues func(*args, **kwargs) to run in a worker thread. Returns True if the job was
+        queued, and False if it was rejected because the queue is full or being drained.
+        """
+        with self._cond:
+            if not self._accepting or len(self._jobs) >= self.max_queue:
+                self.rejected += 1
+                log.warning('workerpool: rejecting job %s for %s (queue depth %s/%s%s)', func.__name__,
+                            self.name, len(self._jobs), self.max_queue, '' if self._accepting else ', draining')
+                return False
+
+            self._jobs.append(_Job(func, args, kwargs, time.monotonic()))
+            self.submitted += 1
+            self._wake()
+        return True
+
+    def _wake(self):
+        """Hands queued jobs to an idle worker, starting a new one if none are free."""
+        self._cond.notify()
+        if len(self._jobs) > self._idle and self._threads < self.max_threads:
+            self._threads += 1
+            threading.Thread(target=self._worker, daemon=True,
+                             name='workerpool-%s-%s' % (self.name, self._threads)).start()
+
+    def _resolve(self, func):
+        """
+        Returns the current version of a job's function. Jobs handed over from an unloaded
+        plugin instance run with the function from its reloaded module, if there is one.
+        """
+        module = sys.modules.get(func.__module__)
+        return getattr(module, func.__name__, func)
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while self._held or not self._jobs:
+                    self._idle += 1
+                    woken = self._cond.wait(IDLE_TIMEOUT)
+                    self._idle -= 1
+                    if not woken and (self._held or not self._jobs):
+                        self._threads -= 1
+                        return
+                job = self._jobs.popleft()
+                self.running += 1
+
+            started = time.monotonic()
+            wait = started - job.submitted
+            try:
+                self._resolve(job.func)(*job.args, **job.kwargs)
+            except Exception:
+                log.exception('workerpool: job %s for %s failed', job.func.__name__, self.name)
+                failed = True
+            else:
+                failed = False
+
+            with self._cond:
+                self.running -= 1
+                self.completed += 1
+                self.failed += failed
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+                self.total_runtime += time.monotonic() - started
+                self._cond.notify_all()  # Wake up drain(), if it's waiting
+
+    def drain(self, timeout=DRAIN_TIMEOUT):
+        """
+        Stops accepting jobs and waits up to timeout seconds for queued and running jobs to
+        finish. Jobs still queued after that are held until the plugin registers again.
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self._accepting = False
+            while self._jobs or self.running:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            if self._jobs:
+                self._held = True
+                log.info('workerpool: holding %s unfinished job(s) for %s until it is reloaded',
+                         len(self._jobs), self.name)
+
+    def resume(self, max_threads, max_queue):
+        """Resumes a drained queue (with possibly new limits), restarting any held jobs."""
+        with self._cond:
+            self.max_threads = max_threads
+            self.max_queue = max_queue
+            self._accepting = True
+            self._held = False
+            if self._jobs:
+                log.info('workerpool: resuming %s held job(s) for %s', len(self._jobs), self.name)
+            for _ in range(min(len(self._jobs), self.max_threads)):
+                self._wake()
+
+def register(name, max_threads=DEFAULT_MAX_THREADS, max_queue=DEFAULT_MAX_QUEUE):
+    """
+    Returns the worker queue for the given plugin name, creating it if needed. This should be
+    called from the plugin's main(); if an earlier instance of the plugin left jobs behind, they
+    are resumed here.
+    """
+    with queues_lock:
+        queue = queues.get(name)
+        if queue is None:
+            queue = queues[name] = WorkerQueue(name, max_threads=max_threads, max_queue=max_queue)
+        else:
+            queue.resume(max_threads, max_queue)
+    return queue
+
+def _format_ms(seconds):
+    return '%.1fms' % (seconds * 1000)
+
+@utils.add_cmd
+def workerstats(irc, source, args):
+    """takes no arguments.
+
+    Shows queue depth, latency and rejection counters for each plugin using shared worker threads."""
+    permissions.check_permissions(irc, source, ['workerpool.stats'])
+
+    if not queues:
+        irc.reply("No plugins are using worker threads.")
+        return
+
+    for name, queue in sorted(queues.items()):
+        with queue._cond:
+            completed = queue.completed or 1  # Avoid dividing by zero
+            irc.reply('\x02%s\x02: %s/%s thread(s) busy, queue %s/%s%s, %s submitted, %s completed, '
+                      '%s failed, %s rejected, wait avg %s / max %s, runtime avg %s' %
+                      (name, queue.running, queue.max_threads, queue.depth, queue.max_queue,
+                       ' (held)' if queue._held else '', queue.submitted, queue.completed,
+                       queue.failed, queue.rejected, _format_ms(queue.total_wait / completed),
+                       _format_ms(queue.max_wait), _format_ms(queue.total_runtime / completed)),
+                      private=True)